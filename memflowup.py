@@ -1,8 +1,18 @@
 #!/usr/bin/python3
 
-import sys, shutil, io, tarfile, json, os, subprocess, urllib.request as request
+import sys, shutil, tarfile, json, os, subprocess, threading, functools, time, base64, http.client
+import urllib.request as request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urljoin
 from os.path import expanduser, join, basename
 
+# orjson is optional, the script has to keep working with just the standard library
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 args = sys.argv[1:]
 
 # Setup stdout in case the script was piped in on *nix
@@ -16,6 +26,31 @@ connectors = ['memflow-qemu-procfs', 'memflow-coredump', 'memflow-kvm']
 registry = 'https://crates.io/api/v1/crates'
 
 DB_FILE = 'db.json'
+META_CACHE_FILE = 'meta_cache.json'
+
+# crates.io lookups are latency bound, fetch a handful of them at once
+FETCH_WORKERS = 6
+
+USER_AGENT = 'memflowup (https://github.com/memflow/memflowup)'
+HTTP_TIMEOUT = 30
+MAX_REDIRECTS = 5
+
+# transient crates.io failures are retried with exponential backoff
+RETRY_COUNT = 3
+RETRY_BACKOFF = 0.5
+RETRY_MAX_DELAY = 30
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# read size used when extracting crate tarballs off the network
+STREAM_BUFFER_SIZE = 128 * 1024
+
+# top level crate directories that are not needed for a release build,
+# unless the manifest declares targets in them explicitly
+SKIPPED_CRATE_DIRS = {
+    'tests': '[[test]]',
+    'benches': '[[bench]]',
+    'examples': '[[example]]'
+}
 
 def is_posix():
     return os.name == 'posix'
@@ -26,34 +61,235 @@ def is_root():
     else:
         return False
 
-def make_dirs(path, as_root):
-    try:
-        if as_root and not is_root():
-            subprocess.check_output('sudo mkdir -p %s'%path, shell=True)
-        else:
-            os.makedirs(path)
-    except:
-        pass
+HOME = expanduser("~")
+USER_CONNECTOR_DIR = join(HOME, '.memflow', 'connectors')
+
+# building is always done as current user
+CONNECTOR_CACHE = USER_CONNECTOR_DIR if not is_root() else '/var/memflowup/connectors'
+
+def make_dirs(paths, as_root):
+    # a single sudo call for all directories, mkdir -p takes any number of them
+    if as_root and not is_root():
+        try:
+            subprocess.check_call(['sudo', 'mkdir', '-p'] + paths)
+        except:
+            pass
+    else:
+        for path in paths:
+            try:
+                os.makedirs(path)
+            except:
+                pass
 
 def copy_file(path, output, as_root):
     try:
         if as_root and not is_root():
-            subprocess.check_output('sudo cp %s %s'%(path, output), shell=True)
+            subprocess.check_call(['sudo', 'cp', path, output])
         else:
-            shutil.copy2(path, output)
+            # the metadata of cargo's output does not matter, just make the library loadable.
+            # copyfile already copies in kernel space where possible (sendfile on Linux, fcopyfile on macOS)
+            shutil.copyfile(path, output)
+            os.chmod(output, 0o755)
         return True
     except:
         print('failed to copy file!')
         return False
 
-def untar(dest_dir, buf):
-    buf_file = io.BytesIO(buf)
-    tar = tarfile.open(fileobj=buf_file, mode='r:gz')
-    tar.extractall(dest_dir)
+def json_loads(data):
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj):
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+def lib_name(crate):
+    # cargo reports library targets with dashes replaced by underscores
+    return crate.replace('-', '_')
+
+def artifact_name(crate):
+    lib = lib_name(crate)
+    if sys.platform == 'win32':
+        return lib + '.dll'
+    elif sys.platform == 'darwin':
+        return 'lib%s.dylib'%lib
+    else:
+        return 'lib%s.so'%lib
+
+def untar(dest_dir, stream):
+    # stream mode decompresses and extracts while the archive is still downloading
+    with tarfile.open(fileobj=stream, mode='r|gz', bufsize=STREAM_BUFFER_SIZE) as tar:
+        # nothing is skipped until the manifest has been seen, cargo packages it before the directories
+        skipped = ()
+        for member in tar:
+            # cargo only needs the files themselves, directories are created on demand
+            if not member.isfile():
+                continue
+            parts = member.name.split('/')
+            # never write outside of the destination directory
+            if os.path.isabs(member.name) or '..' in parts:
+                continue
+            if len(parts) > 2 and parts[1] in skipped:
+                continue
+            if hasattr(tarfile, 'data_filter'):
+                tar.extract(member, dest_dir, set_attrs=False, filter='data')
+            else:
+                tar.extract(member, dest_dir, set_attrs=False)
+            if len(parts) == 2 and parts[1] == 'Cargo.toml':
+                with open(join(dest_dir, member.name), encoding='utf-8', errors='replace') as f:
+                    manifest = f.read()
+                skipped = [d for d, header in SKIPPED_CRATE_DIRS.items() if header not in manifest]
+
+# idle keep-alive connections per host, shared between all threads
+idle_connections = {}
+connections_lock = threading.Lock()
+
+def new_connection(host):
+    # honour https_proxy/no_proxy like urlopen did, by tunneling through the proxy
+    proxy = request.getproxies().get('https')
+    if not proxy or request.proxy_bypass(urlsplit('https://' + host).hostname):
+        return http.client.HTTPSConnection(host, timeout=HTTP_TIMEOUT)
+
+    proxy = urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+    conn = http.client.HTTPSConnection(proxy.hostname, proxy.port or 80, timeout=HTTP_TIMEOUT)
+    tunnel_headers = {}
+    if proxy.username:
+        credentials = '%s:%s'%(request.unquote(proxy.username), request.unquote(proxy.password or ''))
+        tunnel_headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+    conn.set_tunnel(host, headers=tunnel_headers)
+    return conn
+
+def acquire_connection(host):
+    # returns the connection and whether it was reused from the idle pool
+    with connections_lock:
+        idle = idle_connections.get(host)
+        if idle:
+            return idle.pop(), True
+    return new_connection(host), False
+
+def release_connection(host, conn):
+    with connections_lock:
+        idle_connections.setdefault(host, []).append(conn)
+
+def open_request(host, path, headers):
+    conn, reused = acquire_connection(host)
+    try:
+        conn.request('GET', path, headers=headers)
+        return conn, conn.getresponse()
+    except (http.client.HTTPException, OSError):
+        conn.close()
+        # fresh connections are retried with backoff by send_request
+        if not reused:
+            raise
+        # the server may have dropped the connection while it was idle
+        conn = new_connection(host)
+        conn.request('GET', path, headers=headers)
+        return conn, conn.getresponse()
+
+def send_request(host, path, headers):
+    for attempt in range(RETRY_COUNT + 1):
+        delay = RETRY_BACKOFF * 2 ** attempt
+        try:
+            conn, resp = open_request(host, path, headers)
+        except (http.client.HTTPException, OSError):
+            if attempt == RETRY_COUNT:
+                raise
+        else:
+            if resp.status not in RETRY_STATUSES or attempt == RETRY_COUNT:
+                return conn, resp
+            retry_after = resp.getheader('Retry-After')
+            if retry_after and retry_after.isdigit():
+                delay = min(int(retry_after), RETRY_MAX_DELAY)
+            resp.read()
+            release_connection(host, conn)
+        time.sleep(delay)
+
+@contextmanager
+def http_get(url, headers={}):
+    headers = dict(headers)
+    headers['User-Agent'] = USER_AGENT
+
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        if parts.scheme != 'https':
+            raise IOError('GET %s failed: only https is supported'%url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        conn, resp = send_request(parts.netloc, path, headers)
+
+        if resp.status in (301, 302, 303, 307, 308):
+            resp.read()
+            release_connection(parts.netloc, conn)
+            url = urljoin(url, resp.getheader('Location'))
+            continue
+
+        try:
+            if resp.status >= 400:
+                raise IOError('GET %s failed: %d %s'%(url, resp.status, resp.reason))
+            yield resp
+        finally:
+            # only fully read responses leave the connection reusable
+            if resp.isclosed():
+                release_connection(parts.netloc, conn)
+            else:
+                conn.close()
+        return
+
+    raise IOError('GET %s failed: too many redirects'%url)
+
+# crate metadata from previous runs, revalidated with conditional requests
+meta_cache_path = join(CONNECTOR_CACHE, META_CACHE_FILE)
+meta_cache = None
+meta_cache_lock = threading.Lock()
+
+def get_cached_meta(crate):
+    global meta_cache
+    with meta_cache_lock:
+        if meta_cache is None:
+            try:
+                with open(meta_cache_path, 'rb') as f:
+                    meta_cache = json_loads(f.read())
+            except:
+                meta_cache = {}
+        return meta_cache.get(crate)
+
+def store_cached_meta(crate, entry):
+    with meta_cache_lock:
+        meta_cache[crate] = entry
+        try:
+            tmp_path = meta_cache_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(json_dumps(meta_cache))
+            os.replace(tmp_path, meta_cache_path)
+        except:
+            pass
 
+# the latest versions do not change within a run, so look every crate up only once
+@functools.lru_cache(maxsize=128)
 def get_crate_info(crate):
-    r = request.urlopen(registry + '/' + crate).read()
-    j = json.loads(r.decode('utf-8'))
+    cached = get_cached_meta(crate)
+
+    headers = {}
+    if cached:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    with http_get(registry + '/' + crate, headers) as r:
+        if r.status == 304:
+            r.read()
+            body = cached['body']
+        else:
+            body = r.read().decode('utf-8')
+            store_cached_meta(crate, {
+                'etag': r.getheader('ETag'),
+                'last_modified': r.getheader('Last-Modified'),
+                'body': body
+            })
+
+    j = json_loads(body)
 
     crate = j['crate']
 
@@ -62,82 +298,119 @@ def get_crate_info(crate):
 
     return (name, version)
 
+def get_crate_infos(crates):
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        return list(executor.map(get_crate_info, crates))
+
 class Database:
     def update_installed_connectors(self):
         try:
-            with open(self.db_path) as f:
-                self.installed_connectors = json.load(f)
+            with open(self.db_path, 'rb') as f:
+                self.installed_connectors = json_loads(f.read())
         except:
             self.installed_connectors = {}
 
     def save_connectors(self):
         try:
-            with open(self.tmp_db_path, 'w') as f:
-                json.dump(self.installed_connectors, f)
-            if self.tmp_db_path != self.db_path:
-                copy_file(self.tmp_db_path, self.db_path, self.as_root)
-            prev_connectors = self.installed_connectors
-            self.update_installed_connectors()
-            if prev_connectors != self.installed_connectors:
-                print(prev_connectors)
-                print(self.installed_connectors)
-                print('failed to successfully write the db')
+            with open(self.tmp_db_path, 'wb') as f:
+                f.write(json_dumps(self.installed_connectors))
+                f.flush()
+                os.fsync(f.fileno())
+            # renaming over the old db is atomic, readers see either version but never a partial one
+            if self.as_root and not is_root():
+                # /tmp is usually another filesystem, so first stage a root owned copy next to the db
+                staged_path = self.db_path + '.tmp'
+                subprocess.check_call(['sudo', 'install', '-m', '0644', '-o', 'root', self.tmp_db_path, staged_path])
+                subprocess.check_call(['sudo', 'mv', staged_path, self.db_path])
+            else:
+                os.replace(self.tmp_db_path, self.db_path)
         except:
             print('error saving connector db')
 
 
     def __init__(self, as_root):
         self.as_root = as_root
+        self.db_lock = threading.Lock()
+
+        self.output = join(HOME, '.local', 'lib', 'memflow') if not as_root else '/usr/local/lib/memflow'
 
-        self.output = expanduser('~/.local/lib/memflow') if not as_root else '/usr/local/lib/memflow'
-        make_dirs(self.output, as_root)
+        self.connector_cache = CONNECTOR_CACHE
 
-        # building is always done as current user
-        self.connector_cache = join(expanduser("~"), '.memflow', 'connectors') if not is_root() else '/var/memflowup/connectors'
-        make_dirs(self.connector_cache, as_root)
+        db_dir = USER_CONNECTOR_DIR if not as_root else '/etc/memflowup'
 
-        db_dir = join(expanduser("~"), '.memflow', 'connectors') if not as_root else '/etc/memflowup'
-        make_dirs(db_dir, as_root)
+        make_dirs([self.output, self.connector_cache, db_dir], as_root)
 
         if as_root and not is_root():
-            make_dirs('/tmp', False)
+            make_dirs(['/tmp'], False)
 
         self.db_path = join(db_dir, DB_FILE)
-        self.tmp_db_path = join('/tmp', DB_FILE) if not is_root() and as_root else self.db_path
+        self.tmp_db_path = join('/tmp', DB_FILE) if not is_root() and as_root else self.db_path + '.tmp'
 
         self.update_installed_connectors()
 
     def cargo_build(self, connector):
-        os.chdir(join(self.connector_cache, '%s-%s'%connector))
-        print('executing cargo build')
-        ret = subprocess.check_output('cargo build --release --all-features --message-format=json', shell=True)
-        ret = ret.decode('utf-8')
-        json_lines = [j for j in [json.loads(a) for a in ret.splitlines()] if j['reason'] == 'compiler-artifact' and j['target']['name'] == connector[0]]
-        parsed = json_lines[-1]
+        build_dir = join(self.connector_cache, '%s-%s'%connector)
+        print('executing cargo build for %s-%s'%connector)
+        cmd = ['cargo', 'build', '--release', '--all-features', '--message-format=json']
+        lib = lib_name(connector[0])
+        target_name = '"name":%s'%json.dumps(lib)
+        parsed = None
+        with subprocess.Popen(cmd, cwd=build_dir, stdout=subprocess.PIPE, encoding='utf-8') as proc:
+            for line in proc.stdout:
+                # most messages are not artifacts of our crate (dependencies, build scripts, warnings),
+                # skip them before paying for the json parsing
+                if '"reason":"compiler-artifact"' not in line or target_name not in line:
+                    continue
+                j = json_loads(line)
+                if j.get('target', {}).get('name') == lib:
+                    parsed = j
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        if parsed is None:
+            raise RuntimeError('cargo did not report a build artifact for %s'%connector[0])
 
         compiled_files = [a for a in parsed['filenames'] if not a.endswith('.rlib')]
 
         if len(compiled_files) > 1:
             print('multiple compiled outputs! Trying to match the right one, could break')
-            compiled_files = [a for a in compiled_files if a.endswith('.so') or a.endswith('.dll') or a.endswith('.dyld')]
+            compiled_files = [a for a in compiled_files if a.endswith(('.so', '.dll', '.dylib'))]
 
         return compiled_files[0]
 
-    def install_connector(self, connector):
+    def is_installed(self, connector):
+        return self.installed_connectors.get(connector[0]) == connector[1] and os.path.exists(join(self.output, artifact_name(connector[0])))
+
+    def install_connector(self, connector, force=False):
+        if not force and self.is_installed(connector):
+            print('%s-%s is already installed'%connector)
+            return
+
         print('installing %s-%s'%connector)
 
         if connector[0] == DB_FILE:
             print('crate file can not be name the same as the database file!')
         else:
-            r = request.urlopen("%s/%s/%s/download"%(registry, connector[0], connector[1])).read()
-            untar(self.connector_cache, r)
+            with http_get("%s/%s/%s/download"%(registry, connector[0], connector[1])) as r:
+                untar(self.connector_cache, r)
+                # drain the leftover padding so the connection can be reused
+                r.read()
             built_file = self.cargo_build(connector)
             base_name = basename(built_file)
             install_path = join(self.output, base_name)
-            if copy_file(built_file, install_path, self.as_root):
-                print("installed under: " + install_path)
-                self.installed_connectors[connector[0]] = connector[1]
-                self.save_connectors()
+            # builds run in parallel, but installing may prompt for a sudo password, so do it one at a time
+            with self.db_lock:
+                if copy_file(built_file, install_path, self.as_root):
+                    print("installed under: " + install_path)
+                    self.installed_connectors[connector[0]] = connector[1]
+                    self.save_connectors()
+
+    def install_connectors(self, connectors, force=False):
+        # every connector is built in its own cache directory, so the builds can run side by side
+        connectors = list(dict.fromkeys(connectors))
+        if len(connectors) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=min(len(connectors), os.cpu_count() or 1)) as executor:
+            list(executor.map(lambda c: self.install_connector(c, force), connectors))
 
 user_db = Database(is_root());
 
@@ -170,13 +443,19 @@ def select_crate(crates, val):
 
 def install_new_connectors(db):
     global args
+
+    if '-f' in args and args[0] == '-f':
+        force = True
+        args = args[1:]
+    else:
+        force = False
+
     crates = []
     key_crates = {}
 
     print('Available crates:')
 
-    for i, c in enumerate(connectors):
-        info = get_crate_info(c)
+    for i, info in enumerate(get_crate_infos(connectors)):
         if info[0] in db.installed_connectors:
             installed_str = ' [installed %s]'%db.installed_connectors[info[0]]
         else:
@@ -207,8 +486,7 @@ def install_new_connectors(db):
             print('invalid value entered!')
             return
 
-    for c in selected:
-        db.install_connector(c)
+    db.install_connectors(selected, force)
 
     print("done")
 
@@ -221,20 +499,23 @@ def update_connectors(db):
     else:
         force = False
 
-    for k in db.installed_connectors:
-        nc = get_crate_info(k)
+    installed = list(db.installed_connectors)
+    outdated = []
+
+    for k, nc in zip(installed, get_crate_infos(installed)):
         if force or nc[1] != db.installed_connectors[k]:
-            db.install_connector(nc)
+            outdated.append(nc)
         else:
             print('%s is already up to date (%s)'%(nc[0], nc[1]))
 
+    db.install_connectors(outdated, force)
+
     print("done")
 
-memflow_crate = get_crate_info('memflow')
+# only looked up once an operation needs crates.io, listing or quitting stays offline
+memflow_crate = None
 
 try:
-    print('Latest memflow version: %s\n'%memflow_crate[1])
-
     mode = False
 
     has_sysargs = len(args) > 0
@@ -262,6 +543,10 @@ try:
 
         print(op)
 
+        if op in ("install", "update") and not memflow_crate:
+            memflow_crate = get_crate_info('memflow')
+            print('Latest memflow version: %s\n'%memflow_crate[1])
+
         if op == "install":
             install_new_connectors(db)
         elif op == "update":